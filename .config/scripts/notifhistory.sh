@@ -0,0 +1,14 @@
+#!/usr/bin/env sh
+# pick a past notification in walker and copy its message
+# (notify_history.py only needs the standard library, no venv)
+#
+# walker --dmenu can't re-run a query per keystroke, so it fuzzy-matches a fixed list:
+# the newest $LIMIT messages (about 0.3s and 1.5MB to list 20000). Anything older is
+# found through the full-text index by passing words first: notifhistory.sh invoice amazon
+LIMIT=20000
+
+picked=$(python3 ~/.config/scripts/notify_history.py --dmenu --limit "$LIMIT" "$@" | walker --dmenu | cut -f3-)
+# Esc selects nothing; don't wipe the clipboard for it
+if [ -n "$picked" ]; then
+    wl-copy -- "$picked"
+fi
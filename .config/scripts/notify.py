@@ -1,31 +1,1147 @@
 import asyncio
-import subprocess
+import bisect
+import hashlib
+import json
+import logging
 import os
-from aiohttp import ClientSession
-from aiontfy import Ntfy, Event, Notification
+import random
+import signal
+import tempfile
+import time
+import tomllib
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, replace
+from datetime import datetime, UTC
+from functools import partial
+import orjson
+from aiohttp import ClientError, ClientResponseError, ClientSession, ClientTimeout, WSMsgType
+from aiontfy import Ntfy, Attachment, Event, Notification, Priority, Sound
+from aiontfy.exceptions import NtfyConnectionError, NtfyTimeoutError
+from yarl import URL
 
-TOPICS = ["android-notifications"]
-NTFY_URL = "https://ntfy.voidarc.co.uk"
+from notify_history import HistoryWriter
 
-def send_notification(ntfy_notif: Notification):
+try:
+    from dbus_fast import Message, MessageType, Variant
+    from dbus_fast.aio import MessageBus
+except ImportError:  # no dbus-fast in the venv, always use notify-send
+    MessageBus = None
+
+try:
+    from watchfiles import awatch
+except ImportError:  # no watchfiles in the venv, poll the config mtime instead
+    awatch = None
+
+# servers, topics and per-topic rules, reloaded when the file changes
+CONFIG = os.path.join(os.environ.get("XDG_CONFIG_HOME") or os.path.expanduser("~/.config"), "ntfy-notify", "config.toml")
+CONFIG_POLL = 2  # seconds between mtime checks without watchfiles
+URGENCY = {"low": 0, "normal": 1, "critical": 2}
+
+# sounds are decoded once at startup and played from memory
+SOUND_DIR = os.path.expanduser("~/.local/share/sounds")
+SOUND_FILES = {Sound.DING: "notif.mp3"}  # anything else is looked up as <sound>.mp3
+DEFAULT_SOUND = Sound.DING
+PRIORITY_SOUNDS = {}  # e.g. {Priority.MIN: Sound.NO_SOUND}, used when the topic sets no sound
+SOUND_WINDOW = 1.0  # seconds; triggers closer together than this play once
+PCM = ("s16", 48000, 2)  # format, rate, channels
+
+# dispatch stage between the websocket and the desktop
+QUEUE_SIZE = 64
+WORKERS = 2
+BACKPRESSURE = "drop-oldest"  # or "coalesce": when full, newest message per topic wins
+
+# bursts on one topic/tag collapse into a single "N new messages" digest
+DIGEST_WINDOW = 5  # seconds messages are held once the topic runs out of popups
+DIGEST_MAX = 20  # flush a digest early once this many messages are batched
+DIGEST_LINES = 3  # latest messages quoted in the digest body
+TOPIC_RATE = 0.5  # popups per second per topic, refilled into a bucket of TOPIC_BURST
+TOPIC_BURST = 3
+
+# icons and image attachments, downloaded into a content-addressed LRU cache
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"), "ntfy-notify")
+CACHE_BYTES = 64 * 2**20
+FETCH_CONCURRENCY = 4
+FETCH_DEADLINE = 1.5  # seconds a popup waits for its images before showing without them
+FETCH_TIMEOUT = 60  # a download still running in the background gives up after this
+FETCH_RETRY = 300  # seconds a url that failed to download is not tried again
+FETCH_MAX = 8 * 2**20  # bigger files are never fetched
+FETCH_CHUNK = 64 * 2**10
+
+# latency histograms and counters, served as Prometheus text on a unix socket:
+# curl --unix-socket $XDG_RUNTIME_DIR/ntfy-notify.sock http://localhost/metrics
+METRICS_SOCKET = os.path.join(os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir(), "ntfy-notify.sock")
+
+# seconds to wait before retrying the session bus after it went away
+DBUS_RETRY = 30
+
+# reconnects: last seen message is kept here so missed ones can be replayed with since=
+STATE_DIR = os.path.join(os.environ.get("XDG_STATE_HOME") or os.path.expanduser("~/.local/state"), "ntfy-notify")
+BACKOFF_MIN = 1  # seconds, doubled per failed attempt with full jitter
+BACKOFF_MAX = 300
+WS_HEARTBEAT = 60  # ping interval, catches sockets that died during suspend
+SEEN_IDS = 1024  # recent ids remembered to de-duplicate replay against live
+CURSOR_FLUSH = 1  # seconds the cursor is held in memory before it is written out
+
+log = logging.getLogger("notify")
+
+
+class Histogram:
+    """HDR-style log-linear buckets: `sub` linear steps per power of two, so relative error stays under 1/sub."""
+
+    def __init__(self, lowest=1e-5, octaves=24, sub=8):
+        self.bounds = [lowest * 2**o * (1 + i / sub) for o in range(octaves) for i in range(1, sub + 1)]
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, q):
+        """Upper bound of the bucket holding the q-th percentile."""
+        rank = q / 100 * self.count
+        seen = 0
+        for bound, count in zip(self.bounds + [float("inf")], self.counts):
+            seen += count
+            if count and seen >= rank:
+                return bound
+        return 0.0
+
+
+class Metrics:
+    """Per-stage latency histograms, counters and gauges for the whole pipeline."""
+
+    # stage -> what the histogram covers
+    STAGES = {
+        "server": "ntfy message time to websocket frame received (1s resolution, includes clock skew)",
+        "decode": "frame received to decoded",
+        "queue": "decoded to dispatched to a worker, including aggregation",
+        "notify": "dispatched to the notify call returning, including the image deadline",
+        "sound": "notify returned to sound started",
+        "total": "frame received to sound started, or to notify returned when silent",
+    }
+
+    def __init__(self):
+        self.stages = {stage: Histogram() for stage in self.STAGES}
+        self.counters = dict.fromkeys(
+            ("messages", "dropped", "reconnects", "digests", "sounds_collapsed"), 0
+        )
+        self.gauges = {}  # name -> callable returning the current value
+
+    def observe(self, stage, seconds):
+        self.stages[stage].observe(seconds)
+
+    def inc(self, counter, n=1):
+        self.counters[counter] += n
+
+    def render(self):
+        lines = ["# HELP ntfy_stage_seconds Latency of each notification pipeline stage.",
+                 "# TYPE ntfy_stage_seconds histogram"]
+        for stage, hist in self.stages.items():
+            cumulative = 0
+            for bound, count in zip(hist.bounds, hist.counts):
+                cumulative += count
+                lines.append(f'ntfy_stage_seconds_bucket{{stage="{stage}",le="{bound:.6g}"}} {cumulative}')
+            lines.append(f'ntfy_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {hist.count}')
+            lines.append(f'ntfy_stage_seconds_sum{{stage="{stage}"}} {hist.sum:.9g}')
+            lines.append(f'ntfy_stage_seconds_count{{stage="{stage}"}} {hist.count}')
+        for name, value in self.counters.items():
+            lines += [f"# TYPE ntfy_{name}_total counter", f"ntfy_{name}_total {value}"]
+        for name, gauge in self.gauges.items():
+            lines += [f"# TYPE ntfy_{name} gauge", f"ntfy_{name} {gauge()}"]
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+@asynccontextmanager
+async def serve_metrics(path=METRICS_SOCKET):
+    """Just enough HTTP on a unix socket for curl or a Prometheus scrape through a socket proxy."""
+
+    async def handle(reader, writer):
+        try:
+            while await reader.readline() not in (b"\r\n", b"\n", b""):
+                pass
+            body = metrics.render().encode()
+            writer.write(
+                b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                b"Content-Length: %d\r\n\r\n%s" % (len(body), body)
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    if os.path.exists(path):
+        try:
+            _, writer = await asyncio.open_unix_connection(path)
+        except OSError:
+            os.remove(path)  # stale socket from a previous run
+        else:
+            writer.close()
+            log.error("%s belongs to another running instance, not serving metrics", path)
+            yield None
+            return
+    server = await asyncio.start_unix_server(handle, path)
+    inode = os.stat(path).st_ino
+    try:
+        async with server:
+            yield server
+    finally:
+        try:
+            if os.stat(path).st_ino == inode:  # not replaced by another instance since
+                os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+class Dispatcher:
+    """Bounded queue drained by worker tasks, so slow handlers never block the receive loop."""
+
+    def __init__(self, handler, maxsize=QUEUE_SIZE, workers=WORKERS, policy=BACKPRESSURE):
+        if policy not in ("drop-oldest", "coalesce"):
+            raise ValueError(f"unknown backpressure policy: {policy}")
+        self.handler = handler
+        self.maxsize = maxsize
+        self.workers = workers
+        self.policy = policy
+        self.dropped = 0
+        self._pending = deque()
+        self._wakeup = asyncio.Event()
+        self._tasks = []
+
+    def __len__(self):
+        return len(self._pending)
+
+    def put(self, ntfy_notif: Notification):
+        # called synchronously from the subscribe callback; must never wait
+        if len(self._pending) >= self.maxsize:
+            self.dropped += 1
+            metrics.inc("dropped")
+            if self.policy == "coalesce":
+                for i, queued in enumerate(self._pending):
+                    if queued.topic == ntfy_notif.topic:
+                        self._pending[i] = ntfy_notif
+                        return
+            self._pending.popleft()
+        self._pending.append(ntfy_notif)
+        self._wakeup.set()
+
+    async def _worker(self):
+        while True:
+            while not self._pending:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            ntfy_notif = self._pending.popleft()
+            try:
+                await self.handler(ntfy_notif)
+            except Exception:
+                log.exception("handler failed for %s", ntfy_notif.id)
+
+    async def __aenter__(self):
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        return self
+
+    async def __aexit__(self, *exc):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+
+async def run(*cmd):
+    proc = await asyncio.create_subprocess_exec(
+        *cmd, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL
+    )
+    return await proc.wait()
+
+
+class Notifier:
+    """One long-lived org.freedesktop.Notifications connection, with notify-send as fallback."""
+
+    def __init__(self, app_name="ntfy"):
+        self.app_name = app_name
+        self._bus = None
+        self._retry_at = 0
+        # popup id per key, so repeated messages update one popup in place
+        self._replaces = {}
+
+    async def connect(self):
+        self._retry_at = time.monotonic() + DBUS_RETRY
+        if MessageBus is None:
+            return
+        try:
+            self._bus = await MessageBus().connect()
+        except Exception as e:
+            log.warning("session bus unreachable, using notify-send: %s", e)
+            self._bus = None
+        self._replaces.clear()
+
+    @property
+    def connected(self):
+        return self._bus is not None and self._bus.connected
+
+    async def close(self):
+        if self._bus is not None:
+            self._bus.disconnect()
+            self._bus = None
+
+    async def notify(self, title, message, icon="phone", key=None, urgency=1, image=None):
+        if not self.connected and time.monotonic() >= self._retry_at:
+            await self.connect()
+        if self.connected:
+            try:
+                await self._notify_dbus(title, message, icon, key, urgency, image)
+                return
+            except Exception as e:
+                log.warning("Notify over D-Bus failed, using notify-send: %s", e)
+        hints = ["-h", f"string:image-path:{image}"] if image else []
+        await run("notify-send", "-i", icon, "-u", ("low", "normal", "critical")[urgency], *hints, title, message)
+
+    async def _notify_dbus(self, title, message, icon, key, urgency, image):
+        hints = {"urgency": Variant("y", urgency)}
+        if image:
+            hints["image-path"] = Variant("s", image)
+        reply = await self._bus.call(
+            Message(
+                destination="org.freedesktop.Notifications",
+                path="/org/freedesktop/Notifications",
+                interface="org.freedesktop.Notifications",
+                member="Notify",
+                signature="susssasa{sv}i",
+                body=[
+                    self.app_name,
+                    self._replaces.get(key, 0),
+                    icon,
+                    title,
+                    message,
+                    [],
+                    hints,
+                    -1,
+                ],
+            )
+        )
+        if reply.message_type == MessageType.ERROR:
+            raise RuntimeError(f"{reply.error_name}: {reply.body}")
+        if key is not None:
+            self._replaces[key] = reply.body[0]
+
+    async def __aenter__(self):
+        if MessageBus is None:
+            log.warning("dbus-fast is not installed, every popup forks notify-send (see requirements.txt)")
+        await self.connect()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+def discard(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def url_link(url):
+    return hashlib.sha256(url.encode()).hexdigest() + ".url"
+
+
+class Fetcher:
+    """Icons and image attachments streamed into a size-capped, content-addressed LRU cache on disk.
+
+    Each url is recorded as a <sha256 of url>.url symlink to its content file,
+    so cached downloads survive restarts.
+    """
+
+    def __init__(self, session: ClientSession, cache_dir=CACHE_DIR, max_bytes=CACHE_BYTES, concurrency=FETCH_CONCURRENCY):
+        self.session = session
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self._limit = asyncio.Semaphore(concurrency)
+        self._urls = {}  # url link name -> cached file
+        self._pending = {}  # url -> (download task, monotonic start)
+        self._failed = {}  # url -> monotonic time it may be tried again
+        self._files = OrderedDict()  # cached file -> size, least recently used first
+        os.makedirs(cache_dir, exist_ok=True)
+        files, links = [], []
+        for entry in os.scandir(cache_dir):
+            try:
+                if entry.name.endswith(".part"):
+                    # left over from an interrupted download; younger ones may belong to another instance
+                    if time.time() - entry.stat(follow_symlinks=False).st_mtime > FETCH_TIMEOUT:
+                        discard(entry.path)
+                elif entry.is_symlink():
+                    links.append(entry)
+                else:
+                    stat = entry.stat()
+                    files.append((stat.st_mtime, entry.path, stat.st_size))
+            except FileNotFoundError:
+                pass
+        for _, path, size in sorted(files):
+            self._files[path] = size
+        self.size = sum(self._files.values())
+        for entry in links:
+            path = os.path.join(cache_dir, os.readlink(entry.path))
+            if path in self._files:
+                self._urls[entry.name] = path
+            else:
+                discard(entry.path)
+
+    @staticmethod
+    def _wanted(ntfy_notif: Notification):
+        icon = str(ntfy_notif.icon) if ntfy_notif.icon else None
+        image = None
+        attachment = ntfy_notif.attachment
+        if attachment and (attachment.type or "").startswith("image/") and (attachment.size or 0) <= FETCH_MAX:
+            image = str(attachment.url)
+        return icon, image
+
+    def _start(self, url):
+        if url is None or url_link(url) in self._urls or self._failed.get(url, 0) > time.monotonic():
+            return None
+        if url not in self._pending:
+            task = asyncio.create_task(self._download(url))
+            self._pending[url] = task, time.monotonic()
+            task.add_done_callback(lambda _: self._pending.pop(url, None))
+        return self._pending[url]
+
+    def prefetch(self, ntfy_notif: Notification):
+        """Start downloads as soon as a message arrives, before it waits in the dispatch queue."""
+        for url in self._wanted(ntfy_notif):
+            self._start(url)
+
+    async def get(self, ntfy_notif: Notification, timeout=FETCH_DEADLINE):
+        """Cached (icon, image) paths, None for anything not downloaded within timeout."""
+        icon, image = self._wanted(ntfy_notif)
+        pending = [p for p in (self._start(icon), self._start(image)) if p is not None]
+        if pending:
+            # the deadline counts from when a download started, so a slow url holds up
+            # one popup at most; downloads that miss it keep going and land in the cache
+            now = time.monotonic()
+            wait = max(started + timeout - now for _, started in pending)
+            if wait > 0:
+                await asyncio.wait([task for task, _ in pending], timeout=wait)
+        return self._lookup(icon), self._lookup(image)
+
+    def _lookup(self, url):
+        if url is None:
+            return None
+        path = self._urls.get(url_link(url))
+        if path not in self._files:
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:  # removed behind our back
+            self._forget({path})
+            return None
+        self._files.move_to_end(path)
+        return path
+
+    async def _download(self, url):
+        async with self._limit:
+            fd, part = tempfile.mkstemp(dir=self.cache_dir, suffix=".part")
+            digest = hashlib.sha256()
+            size = 0
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    async with self.session.get(url, timeout=ClientTimeout(total=FETCH_TIMEOUT)) as r:
+                        r.raise_for_status()
+                        async for chunk in r.content.iter_chunked(FETCH_CHUNK):
+                            size += len(chunk)
+                            if size > FETCH_MAX:
+                                raise ValueError(f"larger than {FETCH_MAX} bytes")
+                            digest.update(chunk)
+                            f.write(chunk)
+                path = os.path.join(self.cache_dir, digest.hexdigest() + os.path.splitext(URL(url).path)[1][:8])
+                if path in self._files:
+                    discard(part)  # same content under another url
+                else:
+                    os.replace(part, path)
+                    self._files[path] = size
+                    self.size += size
+                link = os.path.join(self.cache_dir, url_link(url))
+                os.symlink(os.path.basename(path), part)
+                os.replace(part, link)
+            except asyncio.CancelledError:
+                discard(part)
+                raise
+            except (ClientError, TimeoutError, ValueError, OSError) as e:
+                log.warning("could not fetch %s, not retrying for %ds: %r", url, FETCH_RETRY, e)
+                discard(part)
+                now = time.monotonic()
+                self._failed = {u: t for u, t in self._failed.items() if t > now}
+                self._failed[url] = now + FETCH_RETRY
+                return
+        self._urls[url_link(url)] = path
+        self._files.move_to_end(path)
+        self._evict()
+
+    def _forget(self, paths):
+        for path in paths:
+            self.size -= self._files.pop(path, 0)
+        for name, path in list(self._urls.items()):
+            if path in paths:
+                del self._urls[name]
+                discard(os.path.join(self.cache_dir, name))
+
+    def _evict(self):
+        evicted = set()
+        while self.size > self.max_bytes and len(self._files) > 1:
+            path = next(iter(self._files))
+            evicted.add(path)
+            self.size -= self._files.pop(path)
+            discard(path)
+        if evicted:
+            self._forget(evicted)
+
+
+async def decode(path):
+    fmt, rate, channels = PCM
+    try:
+        proc = await asyncio.create_subprocess_exec(
+            "ffmpeg", "-v", "error", "-i", path,
+            "-f", f"{fmt}le", "-ar", str(rate), "-ac", str(channels), "-",
+            stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL,
+        )
+    except FileNotFoundError:
+        return None
+    pcm, _ = await proc.communicate()
+    return pcm if proc.returncode == 0 and pcm else None
+
+
+class Player:
+    """Pre-decoded samples written to a single long-lived pw-cat stream, rate limited to one play per window."""
+
+    def __init__(self, window=SOUND_WINDOW):
+        self.window = window
+        self.collapsed = 0
+        self.paths = {}
+        self.samples = {}
+        self._last = float("-inf")
+        self._stream = None
+
+    async def load(self):
+        for sound in Sound:
+            path = os.path.join(SOUND_DIR, SOUND_FILES.get(sound, f"{sound}.mp3"))
+            if sound is not Sound.NO_SOUND and os.path.exists(path):
+                self.paths[sound] = path
+        decoded = await asyncio.gather(*(decode(path) for path in self.paths.values()))
+        self.samples = {s: pcm for s, pcm in zip(self.paths, decoded) if pcm is not None}
+        if len(self.samples) < len(self.paths):
+            log.warning("could not decode all sounds (is ffmpeg installed?), using pw-cat per play")
+
+    async def _open_stream(self):
+        if self._stream is None or self._stream.returncode is not None:
+            fmt, rate, channels = PCM
+            self._stream = await asyncio.create_subprocess_exec(
+                "pw-cat", "--playback", "--raw", "--media-role", "Notification",
+                "--format", fmt, "--rate", str(rate), "--channels", str(channels), "-",
+                stdin=asyncio.subprocess.PIPE, stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+        return self._stream
+
+    async def play(self, sound=DEFAULT_SOUND):
+        """Returns the perf_counter() time the sound started, None if nothing played."""
+        if sound is Sound.NO_SOUND:
+            return None
+        now = time.monotonic()
+        if now - self._last < self.window:
+            self.collapsed += 1
+            metrics.inc("sounds_collapsed")
+            return None
+        self._last = now
+        if sound not in self.paths:
+            sound = DEFAULT_SOUND
+        if sound not in self.samples:
+            if sound not in self.paths:
+                return None
+            started = time.perf_counter()
+            await run("pw-cat", "-p", self.paths[sound])
+            return started
+        stream = await self._open_stream()
+        started = time.perf_counter()
+        try:
+            stream.stdin.write(self.samples[sound])
+            await stream.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            log.warning("playback stream went away, reopening on next sound")
+            self._stream = None
+            return None
+        return started
+
+    async def close(self):
+        if self._stream is not None and self._stream.returncode is None:
+            self._stream.stdin.close()
+            await self._stream.wait()
+        self._stream = None
+
+    async def __aenter__(self):
+        await self.load()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+
+@dataclass(frozen=True)
+class Route:
+    """Rules for one server/topic from the config file."""
+
+    min_priority: int = Priority.MIN
+    tags: frozenset = frozenset()
+    sound: Sound | None = None
+    urgency: int = URGENCY["normal"]
+    icon: str = "phone"
+
+    @classmethod
+    def from_config(cls, rules):
+        return cls(
+            min_priority=int(rules.get("min_priority", Priority.MIN)),
+            tags=frozenset(rules.get("tags", ())),
+            sound=Sound(rules["sound"]) if "sound" in rules else None,
+            urgency=URGENCY[rules.get("urgency", "normal")],
+            icon=rules.get("icon", "phone"),
+        )
+
+    def accepts(self, raw):
+        return (raw.get("priority") or Priority.DEFAULT) >= self.min_priority and self.tags.issubset(raw.get("tags") or ())
+
+
+DEFAULT_ROUTE = Route()
+
+
+def pick_sound(ntfy_notif: Notification, route: Route):
+    if route.sound is not None:
+        return route.sound
+    return PRIORITY_SOUNDS.get(ntfy_notif.priority or Priority.DEFAULT, DEFAULT_SOUND)
+
+
+async def send_notification(notifier: Notifier, player: Player, fetcher: Fetcher, ntfy_notif: Notification):
+    stamps = getattr(ntfy_notif, "stamps", None) or {}
+    dispatched = time.perf_counter()
+    if "decoded" in stamps:
+        metrics.observe("queue", dispatched - stamps["decoded"])
+    route = getattr(ntfy_notif, "route", None) or DEFAULT_ROUTE
     title = ntfy_notif.title or "ntfy"
     message = ntfy_notif.message or ""
-    subprocess.Popen(["notify-send", "-i", "phone", title, message])
-    os.system("pw-cat -p ~/.local/share/sounds/notif.mp3")
+    icon, image = await fetcher.get(ntfy_notif)
+    await notifier.notify(
+        title, message, icon=icon or route.icon, key=ntfy_notif.topic, urgency=route.urgency, image=image
+    )
+    notified = time.perf_counter()
+    metrics.observe("notify", notified - dispatched)
+    started = await player.play(pick_sound(ntfy_notif, route))
+    if started is not None:
+        metrics.observe("sound", started - notified)
+    if "received" in stamps:
+        metrics.observe("total", (started or notified) - stamps["received"])
 
-async def main():
-    async with ClientSession() as session:
-        ntfy = Ntfy(NTFY_URL, session)
+class Frame:
+    """A message frame read straight from the orjson dict; quacks like Notification.
+
+    Only the fields every handler reads are copied out up front. Times, URLs
+    and the attachment are built on first access, anything else goes through
+    the full Notification decoder.
+    """
+
+    __slots__ = ("raw", "id", "topic", "title", "message", "tags", "priority", "route", "stamps", "_cache")
+    event = Event.MESSAGE
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.id = raw["id"]
+        self.topic = raw["topic"]
+        self.title = raw.get("title")
+        self.message = raw.get("message")
+        self.tags = raw.get("tags") or []
+        self.priority = Priority(raw["priority"]) if raw.get("priority") else None
+        self.route = None  # set by the Router
+        self.stamps = {}  # stage -> perf_counter(), for the latency metrics
+        self._cache = {}
+
+    def _lazy(self, name, build):
+        if name not in self._cache:
+            value = self.raw.get(name)
+            self._cache[name] = None if value is None else build(value)
+        return self._cache[name]
+
+    @property
+    def time(self):
+        return self._lazy("time", lambda ts: datetime.fromtimestamp(ts, tz=UTC))
+
+    @property
+    def expires(self):
+        return self._lazy("expires", lambda ts: datetime.fromtimestamp(ts, tz=UTC))
+
+    @property
+    def icon(self):
+        return self._lazy("icon", URL)
+
+    @property
+    def click(self):
+        return self._lazy("click", URL)
+
+    @property
+    def attachment(self):
+        return self._lazy("attachment", Attachment.from_dict)
+
+    def __getattr__(self, name):
+        # actions, content_type, sequence_id, ...
+        if "notification" not in self._cache:
+            self._cache["notification"] = Notification.from_dict(self.raw)
+        return getattr(self._cache["notification"], name)
+
+    def replace(self, **changes):
+        frame = Frame({**self.raw, **changes})
+        frame.route = self.route
+        frame.stamps = self.stamps
+        return frame
+
+    def __repr__(self):
+        return f"Frame(id={self.id!r}, topic={self.topic!r}, title={self.title!r})"
+
+
+def decode_message(data):
+    """Raw dict of a message event, None for open/keepalive/... which are never decoded further."""
+    raw = orjson.loads(data)
+    if raw.get("event") != "message":
+        return None
+    return raw
+
+
+def decode_frame(data):
+    raw = decode_message(data)
+    return None if raw is None else Frame(raw)
+
+
+class SeenIds:
+    """Bounded LRU of message ids."""
+
+    def __init__(self, maxsize=SEEN_IDS):
+        self.maxsize = maxsize
+        self._ids = OrderedDict()
+
+    def add(self, msg_id):
+        """Remember msg_id, returning False if it was already seen."""
+        if msg_id in self._ids:
+            self._ids.move_to_end(msg_id)
+            return False
+        self._ids[msg_id] = None
+        if len(self._ids) > self.maxsize:
+            self._ids.popitem(last=False)
+        return True
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self._stamp = time.monotonic()
+
+    def take(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+
+def digest(batch):
+    last = batch[-1]
+    titles = {n.title for n in batch}
+    source = titles.pop() if len(titles) == 1 and None not in titles else ", ".join(last.tags) or last.topic
+    lines = [
+        f"{n.title}: {n.message}" if n.title and n.title != source else n.message or ""
+        for n in batch[-DIGEST_LINES:]
+    ]
+    title, message = f"{len(batch)} new messages from {source}", "\n".join(lines)
+    if isinstance(last, Frame):
+        return last.replace(title=title, message=message)
+    return replace(last, title=title, message=message)
+
+
+class Aggregator:
+    """Shows messages at once while their topic is under its rate limit, and folds the overflow into one digest per window.
+
+    Duplicate ids never reach it: each Subscription already drops them.
+    """
+
+    def __init__(self, emit, window=DIGEST_WINDOW, max_batch=DIGEST_MAX, rate=TOPIC_RATE, burst=TOPIC_BURST):
+        self.emit = emit
+        self.window = window
+        self.max_batch = max_batch
+        self.rate = rate
+        self.burst = burst
+        self.digests = 0
+        self._buckets = {}
+        # key -> messages held back in the open window, and the timer closing it
+        self._batches = {}
+        self._timers = {}
+
+    def _bucket(self, topic):
+        bucket = self._buckets.get(topic)
+        if bucket is None:
+            bucket = self._buckets[topic] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def put(self, ntfy_notif: Notification):
+        key = (ntfy_notif.topic, tuple(ntfy_notif.tags))
+        if key in self._batches:
+            self._batches[key].append(ntfy_notif)
+            if len(self._batches[key]) >= self.max_batch:
+                self._send(self._batches[key])
+                self._batches[key] = []
+        elif self._bucket(ntfy_notif.topic).take():
+            self.emit(ntfy_notif)
+        else:
+            # out of popups: hold this and whatever follows until the window closes
+            self._batches[key] = [ntfy_notif]
+            self._timers[key] = asyncio.get_running_loop().call_later(self.window, self._close, key)
+
+    def _close(self, key):
+        batch = self._batches.pop(key)
+        del self._timers[key]
+        if batch:
+            # the digest is a popup too; later messages show at once again only if tokens are left
+            self._bucket(key[0]).take()
+            self._send(batch)
+
+    def _send(self, batch):
+        if len(batch) == 1:
+            self.emit(batch[0])
+        else:
+            self.digests += 1
+            metrics.inc("digests")
+            self.emit(digest(batch))
 
-        def callback(ntfy_notif: Notification):
-            if ntfy_notif.event is Event.MESSAGE:
-                send_notification(ntfy_notif)
+    async def __aenter__(self):
+        return self
 
-        await ntfy.subscribe(
-            TOPICS,
-            callback,  # this is now a regular function
+    async def __aexit__(self, *exc):
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        self._batches.clear()
+
+
+class Cursor:
+    """Id and time of the last delivered message, persisted across restarts.
+
+    Advancing only updates memory; the file is rewritten at most once per
+    `delay`, and on flush() when the subscription stops.
+    """
+
+    def __init__(self, path, delay=CURSOR_FLUSH):
+        self.path = path
+        self.delay = delay
+        self.id = None
+        self.time = None
+        self._timer = None
+        try:
+            with open(path) as f:
+                data = json.load(f)
+            self.id, self.time = data["id"], data["time"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def advance(self, msg_id, msg_time):
+        if self.time is not None and msg_time < self.time:
+            return
+        self.id, self.time = msg_id, msg_time
+        if self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.delay, self.flush)
+
+    def flush(self):
+        if self._timer is None:
+            return
+        self._timer.cancel()
+        self._timer = None
+        try:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            with open(self.path + ".tmp", "w") as f:
+                json.dump({"id": self.id, "time": self.time}, f)
+            os.replace(self.path + ".tmp", self.path)
+        except OSError as e:
+            log.warning("could not save cursor to %s: %r", self.path, e)
+
+
+class Subscription:
+    """Subscribe forever: reconnect with backoff and catch up on anything missed while away."""
+
+    def __init__(self, ntfy: Ntfy, session: ClientSession, topics, callback, headers=None, accept=None):
+        self.ntfy = ntfy
+        self.session = session
+        self.topics = topics
+        self.callback = callback
+        self.headers = headers
+        # predicate on the raw frame dict, checked before anything is decoded
+        self.accept = accept
+        self.reconnects = 0
+        self.cursor = Cursor(os.path.join(STATE_DIR, f"{ntfy.url.host}-{','.join(topics)}.json"))
+        self._seen = SeenIds()
+        if self.cursor.id is not None:
+            self._seen.add(self.cursor.id)  # already shown before the restart
+        # /auth is only asked again after the server refused us, not on every reconnect
+        self._check_auth = False
+
+    def _deliver(self, data, live=False, after=None):
+        # one bad frame (truncated json, unknown priority, a failing callback) is skipped,
+        # it must not end the subscription
+        try:
+            self._handle(data, live, after)
+        except Exception:
+            log.exception("skipping frame from %s: %.200r", ",".join(self.topics), data)
+
+    def _handle(self, data, live, after):
+        received = time.perf_counter()
+        raw = decode_message(data)
+        if raw is None or (after is not None and raw["time"] < after) or not self._seen.add(raw["id"]):
+            return
+        # filtered messages still move the cursor, they are never worth replaying
+        self.cursor.advance(raw["id"], raw["time"])
+        if self.accept is not None and not self.accept(raw):
+            return
+        frame = Frame(raw)
+        frame.stamps = {"received": received, "decoded": time.perf_counter()}
+        metrics.observe("decode", frame.stamps["decoded"] - received)
+        if live:  # a replayed frame's age is how long we were away, not server latency
+            metrics.observe("server", max(0.0, time.time() - raw["time"]))
+        metrics.inc("messages")
+        self.callback(frame)
+
+    async def _catch_up(self):
+        # one streaming poll request, parsed line by line as the NDJSON arrives
+        url = self.ntfy.url / ",".join(self.topics) / "json"
+        # since=<id> is strictly after that message; ntfy falls back to everything
+        # it still has once the id expired, so anything older than the cursor time is skipped
+        params = {"poll": "1", "since": self.cursor.id}
+        after = self.cursor.time
+        async with self.session.get(url, params=params, headers=self.headers) as r:
+            r.raise_for_status()
+            replayed = 0
+            async for line in r.content:
+                if line.strip():
+                    self._deliver(line, after=after)
+                    replayed += 1
+        if replayed:
+            log.info("caught up on %d messages since %s", replayed, self.cursor.id)
+
+    async def _listen(self, ws):
+        async for msg in ws:
+            if msg.type == WSMsgType.TEXT:
+                self._deliver(msg.data, live=True)
+            elif msg.type in (WSMsgType.CLOSE, WSMsgType.CLOSING, WSMsgType.CLOSED):
+                break
+
+    async def run(self):
+        try:
+            await self._run()
+        finally:
+            self.cursor.flush()
+
+    async def _run(self):
+        url = (
+            self.ntfy.url.with_scheme("wss" if self.ntfy.url.scheme == "https" else "ws")
+            / ",".join(self.topics)
+            / "ws"
         )
+        attempt = 0
+        while True:
+            connected_at = None
+            try:
+                if self._check_auth:
+                    # raises NtfyHTTPError if we really are not allowed in, no point retrying that
+                    await self.ntfy.can_subscribe(self.topics)
+                    self._check_auth = False
+                async with self.session.ws_connect(url, headers=self.headers, heartbeat=WS_HEARTBEAT) as ws:
+                    connected_at = time.monotonic()
+                    # live frames buffer in ws while the replay runs; ids de-duplicate the overlap
+                    if self.cursor.id is not None:
+                        await self._catch_up()
+                    await self._listen(ws)
+                log.warning("websocket to %s closed", url)
+            except (ClientError, TimeoutError, NtfyConnectionError, NtfyTimeoutError) as e:
+                if isinstance(e, ClientResponseError) and e.status in (401, 403):
+                    self._check_auth = True
+                log.warning("subscription to %s failed: %r", url, e)
+            if connected_at is not None and time.monotonic() - connected_at > WS_HEARTBEAT:
+                attempt = 0  # it was a healthy connection, start backing off from scratch
+            delay = random.uniform(0, min(BACKOFF_MAX, BACKOFF_MIN * 2**attempt))
+            attempt += 1
+            self.reconnects += 1
+            metrics.inc("reconnects")
+            await asyncio.sleep(delay)
 
-if __name__ == "__main__":
-    asyncio.run(main())
 
+async def command_output(cmd):
+    proc = await asyncio.create_subprocess_shell(cmd, stdout=asyncio.subprocess.PIPE)
+    out, _ = await proc.communicate()
+    if proc.returncode != 0:
+        raise ValueError(f"{cmd!r} exited with {proc.returncode}")
+    return out.decode().strip()
+
+
+async def load_config(path=CONFIG):
+    """Compile the config file into {url: token} and a {(url, topic): Route} lookup table."""
+    with open(path, "rb") as f:
+        config = tomllib.load(f)
+    defaults = config.get("defaults", {})
+    servers, routes = {}, {}
+    for server in config.get("server", []):
+        url = server["url"].rstrip("/")
+        token = server.get("token")
+        if isinstance(token, dict):
+            token = await command_output(token["command"])
+        servers[url] = token
+        for topic in server.get("topic", []):
+            routes[(url, topic["name"])] = Route.from_config({**defaults, **topic})
+    return servers, routes
+
+
+class Router:
+    """One Subscription per configured server/topic over a shared session, routed by the config rules."""
+
+    def __init__(self, session: ClientSession, emit, path=CONFIG):
+        self.session = session
+        self.emit = emit
+        self.path = path
+        self.routes = {}
+        # (url, token, topic) -> running Subscription task
+        self._tasks = {}
+
+    def __len__(self):
+        return len(self._tasks)
+
+    def _accept(self, url, raw):
+        route = self.routes.get((url, raw["topic"]))
+        return route is not None and route.accepts(raw)
+
+    def _deliver(self, url, frame: Frame):
+        frame.route = self.routes[(url, frame.topic)]
+        self.emit(frame)
+
+    def _done(self, key, task):
+        if self._tasks.get(key) is task:
+            del self._tasks[key]
+        if not task.cancelled() and task.exception() is not None:
+            log.error("subscription to %s/%s stopped", key[0], key[2], exc_info=task.exception())
+
+    async def reload(self):
+        try:
+            servers, routes = await load_config(self.path)
+        except FileNotFoundError:
+            if self._tasks:
+                log.error("%s is missing, keeping the current config", self.path)
+            else:
+                log.error("%s is missing, nothing is subscribed until it is created", self.path)
+            return
+        except (OSError, tomllib.TOMLDecodeError, KeyError, ValueError, TypeError) as e:
+            log.error("keeping the current config, %s is invalid: %r", self.path, e)
+            return
+        # rule changes apply to the running sockets straight away
+        self.routes = routes
+        wanted = {(url, servers[url], topic) for url, topic in routes}
+        for key in self._tasks.keys() - wanted:
+            self._tasks.pop(key).cancel()
+        for key in wanted - self._tasks.keys():
+            url, token, topic = key
+            sub = Subscription(
+                Ntfy(url, self.session, token=token),
+                self.session,
+                [topic],
+                partial(self._deliver, url),
+                headers={"Authorization": f"Bearer {token}"} if token else None,
+                accept=partial(self._accept, url),
+            )
+            task = self._tasks[key] = asyncio.create_task(sub.run())
+            task.add_done_callback(partial(self._done, key))
+        log.info("subscribed to %d topics on %d servers", len(self._tasks), len(servers))
+
+    async def watch(self):
+        if awatch is not None:
+            # editors replace the file on save, so watch the directory; doot installs the
+            # file as a symlink into the dotfiles checkout, where the edits actually land
+            link = os.path.abspath(self.path)
+            while True:
+                target = os.path.realpath(link)
+                async for changes in awatch(*{os.path.dirname(link), os.path.dirname(target)}):
+                    if any(os.path.abspath(path) in (link, target) for _, path in changes):
+                        await self.reload()
+                        if os.path.realpath(link) != target:
+                            break  # the symlink was (re)created, watch where it points now
+        log.info("watchfiles is not installed, checking %s every %ds (see requirements.txt)", self.path, CONFIG_POLL)
+        mtime = self._mtime()
+        while True:
+            await asyncio.sleep(CONFIG_POLL)
+            current = self._mtime()
+            # also catches the file appearing after startup
+            if current is not None and current != mtime:
+                await self.reload()
+            mtime = current
+
+    def _mtime(self):
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except OSError:
+            return None
+
+    async def run(self):
+        await self.reload()
+        await self.watch()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def main():
+    # logging out of Hyprland sends SIGTERM: unwind like Ctrl-C does, so subscriptions flush their cursors
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    # one session, so every subscription shares its connection pool
+    async with ClientSession() as session, Notifier() as notifier, Player() as player:
+        fetcher = Fetcher(session)
+
+        async def handler(ntfy_notif: Notification):
+            await send_notification(notifier, player, fetcher, ntfy_notif)
+
+        async with Dispatcher(handler) as dispatcher, serve_metrics():
+            metrics.gauges["queue_depth"] = lambda: len(dispatcher)
+            def enqueue(ntfy_notif: Notification):
+                fetcher.prefetch(ntfy_notif)
+                dispatcher.put(ntfy_notif)
+
+            with HistoryWriter() as history:
+                metrics.gauges["history_backlog"] = history.backlog
+                metrics.gauges["history_discarded"] = lambda: history.discarded
+
+                async with Aggregator(enqueue) as aggregator:
+                    def receive(frame: Frame):
+                        # every message goes to history, before bursts are folded into digests
+                        history.add(frame.raw)
+                        aggregator.put(frame)
+
+                    # the callbacks only enqueue; the dispatcher workers do the slow part
+                    async with Router(session, receive) as router:
+                        metrics.gauges["subscriptions"] = lambda: len(router)
+                        await router.run()
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    try:
+        asyncio.run(main())
+    except asyncio.CancelledError:  # SIGTERM
+        pass
@@ -0,0 +1,317 @@
+"""Benchmarks for notify.py, run with the same venv: python notify_bench.py <scenario>"""
+
+import argparse
+import asyncio
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, UTC
+import orjson
+from aiohttp import ClientSession, web
+from aiontfy import Event, Notification, Ntfy
+
+import notify
+from notify import WORKERS, Dispatcher, Histogram, Notifier, Subscription, decode_frame, run
+
+
+def fake_notification(i, topic="android-notifications"):
+    return Notification(
+        id=f"bench{i:08d}",
+        time=datetime.now(UTC),
+        event=Event.MESSAGE,
+        topic=topic,
+        title=f"bench {i}",
+        message="hello from notify_bench",
+    )
+
+
+# frames as ntfy sends them; a real stream is mostly keepalives between messages
+RECORDED_FRAMES = [
+    '{"id":"hLg2dTkeWMX1","time":1760780000,"expires":1760823200,"event":"open","topic":"android-notifications"}',
+    '{"id":"o2CYkZa7Kx4P","time":1760780045,"expires":1760823245,"event":"keepalive","topic":"android-notifications"}',
+    '{"id":"q9b7NRw0Jx1c","time":1760780051,"expires":1760823251,"event":"message","topic":"android-notifications",'
+    '"title":"Signal","message":"Alex: are you still coming tonight?","tags":["signal"],"priority":3}',
+    '{"id":"p3Ue1lFb0xQm","time":1760780062,"expires":1760823262,"event":"message","topic":"android-notifications",'
+    '"title":"Gmail","message":"Your order has shipped","tags":["gmail","mail"],"priority":4,'
+    '"click":"https://mail.google.com/","icon":"https://ntfy.voidarc.co.uk/static/img/gmail.png",'
+    '"actions":[{"id":"a1","action":"view","label":"Open","url":"https://mail.google.com/","clear":true}]}',
+    '{"id":"Zc8kYb2MvT4e","time":1760780070,"expires":1760823270,"event":"message","topic":"android-notifications",'
+    '"title":"Photos","message":"Backup complete","priority":2,"attachment":{"name":"IMG_2041.jpg",'
+    '"type":"image/jpeg","size":182341,"expires":1760791270,"url":"https://ntfy.voidarc.co.uk/file/Zc8kYb2MvT4e.jpg"}}',
+    '{"id":"o2CYkZa7Kx4Q","time":1760780090,"expires":1760823290,"event":"keepalive","topic":"android-notifications"}',
+]
+
+
+def report(name, samples, unit="ms"):
+    samples = sorted(samples)
+    p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+    print(
+        f"{name:<12} n={len(samples):<6} p50={statistics.median(samples):8.3f}{unit}"
+        f" p99={p99:8.3f}{unit} max={samples[-1]:8.3f}{unit}"
+    )
+    return p99
+
+
+async def fake_receive_loop(callback, count, interval):
+    # stands in for Ntfy.subscribe: one frame every `interval` seconds,
+    # recording how late each frame is picked up compared to schedule
+    lag = []
+    start = time.perf_counter()
+    for i in range(count):
+        due = start + i * interval
+        await asyncio.sleep(max(0, due - time.perf_counter()))
+        lag.append((time.perf_counter() - due) * 1000)
+        callback(fake_notification(i))
+    return lag
+
+
+async def bench_dispatch(args):
+    slow = args.handler_ms / 1000
+
+    def blocking(ntfy_notif):
+        time.sleep(slow)  # what os.system("pw-cat ...") did to the loop
+
+    async def handler(ntfy_notif):
+        await asyncio.sleep(slow)
+
+    lag = await fake_receive_loop(blocking, args.count, args.interval / 1000)
+    report("inline", lag)
+
+    async with Dispatcher(handler, policy=args.policy) as dispatcher:
+        lag = await fake_receive_loop(dispatcher.put, args.count, args.interval / 1000)
+    p99 = report("dispatcher", lag)
+    if dispatcher.dropped:
+        # expected once handlers are slower than arrivals; the point is that receiving stays on time
+        print(f"dispatcher dropped {dispatcher.dropped} of {args.count} under {args.policy}"
+              f" ({WORKERS} workers x {args.handler_ms}ms handlers vs a frame every {args.interval}ms)")
+    if p99 > args.max_lag:
+        sys.exit(f"FAIL: dispatcher p99 lag {p99:.3f}ms is above {args.max_lag}ms")
+    print(f"ok: dispatcher p99 lag {p99:.3f}ms <= {args.max_lag}ms")
+
+
+async def bench_notifier(args):
+    # current path: fork notify-send for every message
+    start = time.perf_counter()
+    for i in range(args.count):
+        await run("notify-send", "-i", "phone", f"bench {i}", "fork per message")
+    forked = args.count / (time.perf_counter() - start)
+    print(f"notify-send  {forked:10.1f} msg/s")
+
+    async with Notifier() as notifier:
+        if not notifier.connected:
+            print("dbus         session bus unreachable, skipped")
+            return
+        start = time.perf_counter()
+        for i in range(args.count):
+            await notifier.notify(f"bench {i}", "persistent connection", key="bench")
+        persistent = args.count / (time.perf_counter() - start)
+    print(f"dbus         {persistent:10.1f} msg/s ({persistent / forked:.1f}x)")
+
+
+def full_decode(data):
+    ntfy_notif = Notification.from_json(data)
+    if ntfy_notif.event is Event.MESSAGE:
+        return ntfy_notif
+    return None
+
+
+def read_fields(ntfy_notif):
+    # what the popup, sound and aggregation stages look at
+    return ntfy_notif.id, ntfy_notif.topic, ntfy_notif.title, ntfy_notif.message, ntfy_notif.tags, ntfy_notif.priority
+
+
+async def bench_decode(args):
+    if args.frames:
+        with open(args.frames) as f:
+            frames = [line.strip() for line in f if line.strip()]
+    else:
+        frames = RECORDED_FRAMES
+    stream = [frames[i % len(frames)] for i in range(args.count)]
+
+    for name, decode in (("from_json", full_decode), ("fast path", decode_frame)):
+        start = time.perf_counter()
+        for data in stream:
+            ntfy_notif = decode(data)
+            if ntfy_notif is not None:
+                read_fields(ntfy_notif)
+        rate = len(stream) / (time.perf_counter() - start)
+
+        # peak bytes while decoding one frame (orjson's parse buffer is part of both),
+        # and bytes/blocks still held by the decoded result
+        sample = stream[:1000]
+        peak = kept = blocks = 0
+        tracemalloc.start()
+        for data in sample:
+            before_blocks = sys.getallocatedblocks()
+            before = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+            ntfy_notif = decode(data)
+            if ntfy_notif is not None:
+                read_fields(ntfy_notif)
+            current, frame_peak = tracemalloc.get_traced_memory()
+            blocks += sys.getallocatedblocks() - before_blocks
+            peak += frame_peak - before
+            kept += current - before
+            del ntfy_notif
+        tracemalloc.stop()
+        n = len(sample)
+        print(
+            f"{name:<10} {rate:10.0f} frames/s {peak / n:7.0f} peak B/frame"
+            f" {kept / n:6.0f} kept B/frame {blocks / n:5.1f} kept blocks/frame"
+        )
+
+
+class FakeNtfy:
+    """Local stand-in for ntfy: answers /auth and /json polls, and replays messages over /ws at a fixed rate.
+
+    Each message body is the sender's perf_counter(), so an in-process client can measure latency.
+    `keepalives` keepalive frames are interleaved per message, as text frames like ntfy's own.
+    """
+
+    def __init__(self, rate, count, keepalives=0.5):
+        self.rate = rate
+        self.count = count
+        self.keepalives = keepalives
+        self.sent = 0
+        self.app = web.Application()
+        self.app.router.add_get("/{topics}/auth", self.auth)
+        self.app.router.add_get("/{topics}/json", self.poll)
+        self.app.router.add_get("/{topics}/ws", self.ws)
+
+    async def auth(self, request):
+        return web.json_response({"success": True})
+
+    async def poll(self, request):
+        return web.Response(text="", content_type="application/x-ndjson")
+
+    async def ws(self, request):
+        topic = request.match_info["topics"].split(",")[0]
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        await ws.send_str(orjson.dumps({"id": "open", "time": int(time.time()), "event": "open", "topic": topic}).decode())
+        start = time.perf_counter()
+        owed = 0.0
+        for i in range(self.count):
+            delay = start + i / self.rate - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if ws.closed:
+                break
+            await ws.send_str(orjson.dumps({
+                "id": f"{topic}-{i}", "time": int(time.time()), "event": "message", "topic": topic,
+                "title": "load test", "message": f"{time.perf_counter():.9f}", "priority": 3,
+            }).decode())
+            self.sent += 1
+            owed += self.keepalives
+            while owed >= 1:
+                owed -= 1
+                await ws.send_str(orjson.dumps({
+                    "id": f"{topic}-k{i}", "time": int(time.time()), "event": "keepalive", "topic": topic,
+                }).decode())
+        async for _ in ws:  # hold the socket open like ntfy does
+            pass
+        return ws
+
+    async def start(self, host="127.0.0.1", port=0):
+        runner = web.AppRunner(self.app, access_log=None)
+        await runner.setup()
+        site = web.TCPSite(runner, host, port)
+        await site.start()
+        host, port = runner.addresses[0][:2]
+        return runner, f"http://{host}:{port}"
+
+
+async def bench_load(args):
+    # cursors for the throwaway topics, so nothing lands in the real state dir
+    notify.STATE_DIR = tempfile.mkdtemp(prefix="ntfy-load-")
+    best = None
+    for rate in args.rates:
+        count = int(rate * args.duration)
+        server = FakeNtfy(rate, count, args.keepalives)
+        runner, url = await server.start()
+        hist = Histogram()
+        received = 0
+
+        async def handler(frame):
+            nonlocal received
+            hist.observe(time.perf_counter() - float(frame.message))
+            received += 1
+            if args.handler_ms:
+                await asyncio.sleep(args.handler_ms / 1000)
+
+        async with ClientSession() as session, Dispatcher(handler) as dispatcher:
+            sub = Subscription(Ntfy(url, session), session, [f"load-{rate}"], dispatcher.put)
+            task = asyncio.create_task(sub.run())
+            deadline = time.monotonic() + args.duration * 3 + 5
+            while received + dispatcher.dropped < count and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+            task.cancel()
+            await asyncio.gather(task, return_exceptions=True)
+        await runner.cleanup()
+
+        p50, p99 = hist.percentile(50) * 1000, hist.percentile(99) * 1000
+        print(
+            f"{rate:>8} msg/s sent={server.sent:<7} handled={received:<7} dropped={dispatcher.dropped:<6}"
+            f" p50={p50:8.3f}ms p99={p99:8.3f}ms"
+        )
+        if received < count or p99 > args.slo:
+            break
+        best = rate
+    print(f"max sustainable: {best or 'none'} msg/s (all handled, p99 <= {args.slo}ms)")
+
+
+async def bench_serve(args):
+    server = FakeNtfy(args.rate, args.count, args.keepalives)
+    runner, url = await server.start(port=args.port)
+    print(f"fake ntfy on {url}: {args.count} messages at {args.rate} msg/s per websocket")
+    print(f'point a [[server]] url in ~/.config/ntfy-notify/config.toml at it, then read {notify.METRICS_SOCKET}')
+    try:
+        await asyncio.Future()
+    finally:
+        await runner.cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    sub = parser.add_subparsers(dest="scenario", required=True)
+
+    p = sub.add_parser("dispatch", help="receive-loop latency with slow handlers")
+    p.add_argument("--count", type=int, default=200)
+    p.add_argument("--interval", type=float, default=5, help="ms between frames")
+    p.add_argument("--handler-ms", type=float, default=50, help="time each handler takes")
+    p.add_argument("--policy", default="drop-oldest", choices=["drop-oldest", "coalesce"])
+    p.add_argument("--max-lag", type=float, default=20, help="p99 receive lag in ms above which the run fails")
+    p.set_defaults(func=bench_dispatch)
+
+    p = sub.add_parser("notifier", help="messages per second, notify-send vs D-Bus")
+    p.add_argument("--count", type=int, default=200)
+    p.set_defaults(func=bench_notifier)
+
+    p = sub.add_parser("decode", help="frames per second, Notification.from_json vs fast path")
+    p.add_argument("--count", type=int, default=100_000)
+    p.add_argument("--frames", help="NDJSON file of recorded frames, e.g. from /<topic>/json?poll=1&since=all")
+    p.set_defaults(func=bench_decode)
+
+    p = sub.add_parser("load", help="ramp a local fake ntfy until latency or drops give out")
+    p.add_argument("--rates", type=lambda v: [int(r) for r in v.split(",")], default=[100, 500, 1000, 2000, 5000, 10000, 20000])
+    p.add_argument("--duration", type=float, default=3, help="seconds per rate step")
+    p.add_argument("--slo", type=float, default=50, help="p99 latency in ms a rate must stay under")
+    p.add_argument("--handler-ms", type=float, default=0, help="time each handler takes")
+    p.add_argument("--keepalives", type=float, default=0.5, help="keepalive frames sent per message")
+    p.set_defaults(func=bench_load)
+
+    p = sub.add_parser("serve", help="run the fake ntfy for a real notify.py to subscribe to")
+    p.add_argument("--port", type=int, default=8080)
+    p.add_argument("--rate", type=float, default=100)
+    p.add_argument("--count", type=int, default=1000)
+    p.add_argument("--keepalives", type=float, default=0.5, help="keepalive frames sent per message")
+    p.set_defaults(func=bench_serve)
+
+    args = parser.parse_args()
+    asyncio.run(args.func(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""Search notifications received by notify.py.
+
+    notify_history.py [words ...] [--topic T] [--since 7d] [--limit N] [--dmenu | --json]
+
+Only the standard library is imported here, so a launcher binding starts fast.
+"""
+
+import argparse
+import json
+import logging
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+from datetime import datetime
+
+HISTORY_DB = os.path.join(
+    os.environ.get("XDG_DATA_HOME") or os.path.expanduser("~/.local/share"), "ntfy-notify", "history.db"
+)
+MAX_AGE = 365 * 86400  # seconds kept
+MAX_BYTES = 256 * 2**20  # oldest messages go first once the db holds more than this
+BATCH_SIZE = 500
+BATCH_WINDOW = 0.5  # seconds the writer waits to fill a batch
+PRUNE_EVERY = 3600  # seconds between retention passes
+RECONNECT_EVERY = 60  # seconds between attempts to open a db that failed to open
+
+# messages is append-only; the fts table indexes it without a second copy of the text
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    rowid INTEGER PRIMARY KEY,
+    id TEXT NOT NULL UNIQUE,
+    topic TEXT NOT NULL,
+    time INTEGER NOT NULL,
+    title TEXT,
+    message TEXT,
+    tags TEXT,
+    priority INTEGER,
+    raw TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_time ON messages (time);
+CREATE INDEX IF NOT EXISTS messages_topic_time ON messages (topic, time);
+CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5 (
+    title, message, tags, content = 'messages', content_rowid = 'rowid', prefix = '2 3'
+);
+CREATE TRIGGER IF NOT EXISTS messages_insert AFTER INSERT ON messages BEGIN
+    INSERT INTO messages_fts (rowid, title, message, tags) VALUES (new.rowid, new.title, new.message, new.tags);
+END;
+CREATE TRIGGER IF NOT EXISTS messages_delete AFTER DELETE ON messages BEGIN
+    INSERT INTO messages_fts (messages_fts, rowid, title, message, tags)
+    VALUES ('delete', old.rowid, old.title, old.message, old.tags);
+END;
+"""
+
+INSERT = """
+INSERT OR IGNORE INTO messages (id, topic, time, title, message, tags, priority, raw)
+VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+log = logging.getLogger("notify.history")
+
+
+def connect(path=HISTORY_DB):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    db = sqlite3.connect(path, timeout=5)
+    try:
+        # only takes effect on a new db, before any table exists
+        db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+        # WAL so searches never wait on the writer
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = NORMAL")
+        db.executescript(SCHEMA)
+    except BaseException:
+        db.close()
+        raise
+    return db
+
+
+def used_bytes(db):
+    pages = db.execute("PRAGMA page_count").fetchone()[0] - db.execute("PRAGMA freelist_count").fetchone()[0]
+    return pages * db.execute("PRAGMA page_size").fetchone()[0]
+
+
+def prune(db, max_age=MAX_AGE, max_bytes=MAX_BYTES):
+    with db:
+        deleted = db.execute("DELETE FROM messages WHERE time < ?", (int(time.time()) - max_age,)).rowcount
+        used = used_bytes(db)
+        if used > max_bytes:
+            # fts deletes only add tombstones until the index is merged, so the size
+            # can't be re-checked row by row: drop the oldest share in one go, with headroom
+            count = db.execute("SELECT count(*) FROM messages").fetchone()[0]
+            keep = int(count * max_bytes / used * 0.9)
+            deleted += db.execute(
+                "DELETE FROM messages WHERE rowid IN (SELECT rowid FROM messages ORDER BY time LIMIT ?)",
+                (count - keep,),
+            ).rowcount
+        if deleted:
+            db.execute("INSERT INTO messages_fts (messages_fts) VALUES ('optimize')")
+    if deleted:
+        db.executescript("PRAGMA incremental_vacuum;")  # execute() would free a single page
+        db.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+
+
+class HistoryWriter:
+    """Appends raw message dicts to the history db from a thread, one transaction per batch."""
+
+    def __init__(self, path=HISTORY_DB, max_age=MAX_AGE, max_bytes=MAX_BYTES):
+        self.path = path
+        self.max_age = max_age
+        self.max_bytes = max_bytes
+        self.discarded = 0  # messages that arrived while the db could not be opened
+        self._queue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._run, name="history", daemon=True)
+
+    def add(self, raw):
+        # called on the event loop: only a queue put, everything else happens in the thread
+        self._queue.put(raw)
+
+    def backlog(self):
+        return self._queue.qsize()
+
+    def _batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + BATCH_WINDOW
+        while batch[-1] is not None and len(batch) < BATCH_SIZE:
+            try:
+                batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+            except queue.Empty:
+                break
+        return batch
+
+    def _open(self):
+        try:
+            return connect(self.path)
+        except (sqlite3.Error, OSError) as e:
+            log.error("history is off, retrying in %ds: cannot open %s: %r", RECONNECT_EVERY, self.path, e)
+            return None
+
+    def _run(self):
+        db = self._open()
+        retry_at = time.monotonic() + RECONNECT_EVERY
+        pruned = 0
+        while True:
+            batch = self._batch()
+            if db is None and time.monotonic() >= retry_at:
+                db = self._open()
+                retry_at = time.monotonic() + RECONNECT_EVERY
+            rows = [
+                (
+                    raw["id"], raw["topic"], raw["time"], raw.get("title"), raw.get("message"),
+                    " ".join(raw.get("tags") or ()), raw.get("priority"), json.dumps(raw),
+                )
+                for raw in batch
+                if raw is not None
+            ]
+            if db is None:
+                # keep draining the queue so memory stays bounded until the db is back
+                self.discarded += len(rows)
+            else:
+                try:
+                    if rows:
+                        with db:
+                            db.executemany(INSERT, rows)
+                    if time.monotonic() - pruned > PRUNE_EVERY:
+                        prune(db, self.max_age, self.max_bytes)
+                        pruned = time.monotonic()
+                except sqlite3.Error:
+                    log.exception("could not write %d messages to %s", len(rows), self.path)
+            if batch[-1] is None:
+                if db is not None:
+                    db.close()
+                return
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._queue.put(None)
+        self._thread.join()
+
+
+def fts_query(words):
+    # every word must match, as a prefix so results narrow while typing
+    return " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+
+
+def search(db, words=(), topic=None, since=None, limit=50):
+    sql = "SELECT m.time, m.topic, m.title, m.message, m.tags, m.priority, m.id FROM messages m"
+    where, args = [], []
+    words = [word for word in words if word.strip()]
+    if words:
+        sql += " JOIN messages_fts ON messages_fts.rowid = m.rowid"
+        where.append("messages_fts MATCH ?")
+        args.append(fts_query(words))
+    if topic:
+        where.append("m.topic = ?")
+        args.append(topic)
+    if since:
+        where.append("m.time >= ?")
+        args.append(since)
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    # rowid is arrival order, which fts5 can walk newest first and stop at the limit
+    sql += f" ORDER BY {'messages_fts' if words else 'm'}.rowid DESC LIMIT ?"
+    args.append(limit)
+    return db.execute(sql, args).fetchall()
+
+
+def parse_since(value):
+    units = {"m": 60, "h": 3600, "d": 86400, "w": 604800}
+    if value[-1:] in units:
+        return int(time.time() - float(value[:-1]) * units[value[-1]])
+    return int(value)
+
+
+def flat(text):
+    return " ".join((text or "").split())
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Search notifications received by notify.py.")
+    parser.add_argument("words", nargs="*", help="full-text search over title, message and tags")
+    parser.add_argument("--topic")
+    parser.add_argument("--since", type=parse_since, help="e.g. 30m, 12h, 7d, 2w or a unix time")
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--db", default=HISTORY_DB)
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("--dmenu", action="store_true", help="date, title and message separated by tabs, one per line")
+    output.add_argument("--json", action="store_true", help="one JSON object per line")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.db):
+        return
+    db = sqlite3.connect(f"file:{args.db}?mode=ro", uri=True)
+    try:
+        rows = search(db, args.words, args.topic, args.since, args.limit)
+    except sqlite3.OperationalError as e:  # e.g. a stray FTS operator while typing
+        sys.exit(f"notify_history: {e}")
+    try:
+        for msg_time, topic, title, message, tags, priority, msg_id in rows:
+            when = datetime.fromtimestamp(msg_time).strftime("%Y-%m-%d %H:%M")
+            if args.json:
+                print(json.dumps({
+                    "id": msg_id, "time": msg_time, "topic": topic, "title": title,
+                    "message": message, "tags": tags.split(), "priority": priority,
+                }))
+            elif args.dmenu:
+                print(f"{when}\t{flat(title)}\t{flat(message)}")
+            else:
+                print(f"{when}  [{topic}] {flat(title) + ': ' if title else ''}{flat(message)}")
+    except BrokenPipeError:  # the picker was closed before it read everything
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+
+
+if __name__ == "__main__":
+    main()